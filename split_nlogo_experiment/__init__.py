@@ -21,60 +21,420 @@ __version__ = "0.3.2"
 import sys
 import os.path
 import argparse
-from xml.dom import minidom
-import string
+import collections
+import contextlib
+import copy
 import csv
+import functools
+import io
+import itertools
+import mmap
+import re
+import stat
+import string
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape
+
+from lxml import etree
+
+
+# Extra entities needed when escaping values put in double quoted attributes.
+_ATTR_ENTITIES = {'"': "&quot;"}
+
+# Matches the contents of an experiments block in an .nlogo file.
+_EXPERIMENTS_RE = re.compile(rb"<experiments>(.*?)</experiments>", re.DOTALL)
+
+# Replacements of characters in experiment names that may cause problems in
+# file names.
+_NAME_XLATE = str.maketrans({' ': '_', '/': '-', '\\': '-'})
+
+# Formats an enumeratedValueSet tag holding a single value, given the escaped
+# variable name and value.
+_VALUE_SET_FORMAT = ('<enumeratedValueSet variable="{}">'
+                     '<value value="{}"/>'
+                     '</enumeratedValueSet>').format
+
+# Start and end of every experiment XML file.
+_XML_HEADER = (b"""<?xml version="1.0" encoding="us-ascii"?>\n"""
+               b"""<!DOCTYPE experiments SYSTEM "behaviorspace.dtd">\n"""
+               b"""<experiments>\n""")
+_XML_FOOTER = b"""</experiments>\n"""
+
+# Closing tag of a serialized experiment.
+_EXP_END_TAG = b"</experiment>"
+
+# Experiments with fewer runs than this are written without worker processes,
+# as starting them costs more than it saves.
+_PARALLEL_MIN_RUNS = 1000
+
+# Number of runs sent to each worker process at a time, and the number of
+# such chunks per worker that may be in flight at once. Limiting the chunks in
+# flight keeps the runs from all being held in memory.
+_PARALLEL_CHUNKSIZE = 64
+_PARALLEL_QUEUED_CHUNKS = 4
+
+# Buffer size used for output files.
+_BUFFER_SIZE = 1 << 20
+
+# Characters that require a run table field to be quoted.
+_CSV_SPECIAL_CHARS = frozenset(',"\r\n')
 
 
-def expandValueSets(value_tuples):
+def formatRunTableRow(row):
     """
-    Recursive generator giving the different combinations of variable values.
+    Format a run table row as a line of CSV.
+
+    Values rarely need quoting, so rows are joined directly. Only rows with a
+    value that needs quoting are formatted using csv.writer.
 
     Parameters
     ----------
 
-    value_tuples : list
-       List of tuples, each tuple is on the form
-       (variable_name, [value_0, value_1, ... , value_N])
-       where the value list is the possible values for that variable.
+    row : list
+       The values of the row.
+
+    Returns
+    -------
+
+    line : bytes
+       The formatted row, including line terminator.
+
+    """
+    fields = [str(value) for value in row]
+    if all(_CSV_SPECIAL_CHARS.isdisjoint(field) for field in fields):
+        return (",".join(fields) + "\r\n").encode()
+
+    line = io.StringIO()
+    csv.writer(line).writerow(fields)
+    return line.getvalue().encode()
+
+
+def extractExperimentsXML(nlogo_data):
+    """
+    Extract the experiments blocks of an .nlogo file.
+
+    Parameters
+    ----------
+
+    nlogo_data : bytes-like
+       Contents of the .nlogo file, for instance bytes or a memory map.
+
+    Returns
+    -------
+
+    experiments_xml : bytes
+       All experiments blocks of the file, one after the other.
+
+    """
+    return b"".join(
+        b"<experiments>" + match.group(1) + b"</experiments>\n"
+        for match in _EXPERIMENTS_RE.finditer(nlogo_data))
+
+
+@functools.lru_cache(maxsize=4096)
+def escapeAttribute(value):
+    """
+    Escape a value to be put in a double quoted XML attribute.
+
+    The same variable names and values occur in many individual runs, so
+    the results are cached.
+
+    Parameters
+    ----------
+
+    value : object
+       The attribute value.
+
+    Returns
+    -------
+
+    escaped_value : str
+       The escaped attribute value.
+
+    """
+    return escape(str(value), _ATTR_ENTITIES)
+
+
+def createValueSetsXML(value_combination):
+    """
+    Create the enumeratedValueSet tags for one variable value combination.
+
+    Parameters
+    ----------
+
+    value_combination : iterable
+       Iterable of (variable_name, value) tuples.
+
+    Returns
+    -------
+
+    value_sets_xml : bytes
+       The enumeratedValueSet tags, each holding a single value, encoded
+       as us-ascii.
+
+    """
+    return "".join(
+        [_VALUE_SET_FORMAT(escapeAttribute(evs_name), escapeAttribute(evs_value))
+         for evs_name, evs_value in value_combination]
+        ).encode("us-ascii", "xmlcharrefreplace")
+
+
+def createExperimentXMLDocument(experiment_xml):
+    """
+    Wrap a serialized experiment tag in an experiments tag, furnished with
+    the DOCTYPE tag recognized by netlogo.
+
+    Parameters
+    ----------
+
+    experiment_xml : list
+       List of bytes fragments that together make up an experiment tag and
+       its children, encoded as us-ascii.
+
+    Returns
+    -------
+
+    document : bytes
+       The complete XML document.
+
+    """
+    return b"".join([_XML_HEADER, *experiment_xml, _XML_FOOTER])
+
+
+def usableCPUCount():
+    """
+    Number of CPUs this process may run on, respecting CPU affinity where
+    the platform supports it.
+
+    Returns
+    -------
+
+    count : int
+       The number of usable CPUs, at least 1.
+
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def expandExperimentRuns(value_combinations,
+                         reps_of_experiment,
+                         experiment_body,
+                         output_dir,
+                         file_prefix,
+                         num_individual_runs):
+    """
+    Set up the individual runs of an experiment.
+
+    Parameters
+    ----------
+
+    value_combinations : iterable
+       Iterable of variable value combinations, each a list of
+       (variable_name, value) tuples.
+
+    reps_of_experiment : int
+       Number of runs created for each value combination.
+
+    experiment_body : bytes
+       The serialized experiment tag without its closing tag.
+
+    output_dir : str
+       Path to the directory of the XML files.
+
+    file_prefix : str
+       Start of the XML file names, the run number is added to this.
+
+    num_individual_runs : int
+       Number of unique value combinations.
 
     Yields
     ------
-       : Each yield results in a list of unique variable_name and value
-       combination for all variables listed in the original value_tuples.
+       : One (enum, value_combination, experiment_body, xml_filename) tuple
+       per individual run, numbered from 1.
 
     """
-    if len(value_tuples) == 1:
-        for val in value_tuples[0][1]:
-            yield [(value_tuples[0][0], val)]
-    else:
-        for val in value_tuples[0][1]:
-            for vlist in expandValueSets(value_tuples[1:]):
-                yield [(value_tuples[0][0], val)] + vlist
+    # File names only differ in the zero padded run number.
+    pad = len(str(num_individual_runs))
+    name_prefix = os.path.join(output_dir, file_prefix) + '_'
 
+    enum = 1
+    for exp in value_combinations:
+        for exp_clone in range(reps_of_experiment):
+            xml_filename = f"{name_prefix}{enum:0{pad}d}.xml"
+            yield (enum, exp, experiment_body, xml_filename)
+            enum += 1
 
-def saveExperimentToXMLFile(experiment, xmlfile):
+
+def mapInWindow(executor, fn, iterable, window_size):
     """
-    Given an experiment XML node saves it to a file wrapped in an experiments
-    tag.  The file is also furnished with DOCTYPE tag recognized by netlogo.
-    File name will be the experiment name followed by the experiment number
-    (zero padded), optionally prefixed.
+    Like executor.map, but with at most window_size calls in flight, so that
+    long iterables are not consumed up front. A new call is submitted as soon
+    as the result of the oldest one has been taken.
 
     Parameters
     ----------
 
-    experiment : xml node
-       An experiment tag node and its children.
+    executor : concurrent.futures.Executor
+       The executor to run fn in.
+
+    fn : callable
+       Function to call for each item.
+
+    iterable : iterable
+       The items.
+
+    window_size : int
+       Maximum number of calls in flight.
+
+    Yields
+    ------
+       : The results of fn, in the order of the items.
 
-    xmlfile : file pointer
-       File opened for writing.
     """
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= window_size:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
 
-    xmlfile.write("""<?xml version="1.0" encoding="us-ascii"?>\n""")
-    xmlfile.write("""<!DOCTYPE experiments SYSTEM "behaviorspace.dtd">\n""")
-    xmlfile.write("""<experiments>\n""")
-    experiment.writexml(xmlfile)
-    xmlfile.write("""</experiments>\n""")
+
+def emitExperimentRun(task):
+    """
+    Save the XML file of one individual experiment run.
+
+    Parameters
+    ----------
+
+    task : tuple
+       Tuple on the form (enum, value_combination, experiment_body,
+       xml_filename), where enum is the experiment run number,
+       value_combination a list of (variable_name, value) tuples for the run,
+       experiment_body the serialized experiment tag without its closing tag,
+       and xml_filename the name of the file to save.
+
+    Returns
+    -------
+
+    enum : int
+       The experiment run number.
+
+    run_row : list
+       The run table row of the experiment run.
+
+    """
+    enum, value_combination, experiment_body, xml_filename = task
+    document = memoryview(createExperimentXMLDocument(
+        [experiment_body, createValueSetsXML(value_combination), _EXP_END_TAG]))
+
+    # The document is complete, write it straight to the file descriptor
+    # without going through a file object.
+    fd = os.open(xml_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        while document:
+            document = document[os.write(fd, document):]
+    except OSError as ose:
+        # Errors from os.write do not carry the file name.
+        raise OSError(ose.errno, ose.strerror, xml_filename) from ose
+    finally:
+        os.close(fd)
+    return enum, [enum] + [evs_value for _, evs_value in value_combination]
+
+
+def emitExperimentRuns(tasks):
+    """
+    Save the XML files of several individual experiment runs.
+
+    Parameters
+    ----------
+
+    tasks : list
+       List of tasks, as taken by emitExperimentRun.
+
+    Returns
+    -------
+
+    results : list
+       The (enum, run_row) tuples returned by emitExperimentRun, one per task.
+
+    """
+    return [emitExperimentRun(task) for task in tasks]
+
+
+def scriptTemplateValues(nlogofile, experiment, numexps, csv_output_dir="."):
+    """
+    The values of the keys that can be used in a script template.
+
+    Parameters
+    ----------
+
+    nlogofile : string
+       File name and path of the nlogo model file.
+
+    experiment : string
+       Name of the experiment.
+
+    numexps : int
+       Number of experiments.
+
+    csv_output_dir : str, optional
+       Path to the directory containing the CSV files.
+
+    Returns
+    -------
+
+    values : dict
+       Mapping from each supported key to its value.
+
+    """
+    return {
+        "experiment": experiment,
+        "numexps": numexps,
+        "model": nlogofile,
+        "modelname": os.path.basename(nlogofile).split('.')[0],
+        "csvfpath": csv_output_dir
+        }
+
+
+# Keys that can be used in script templates.
+_SCRIPT_TEMPLATE_KEYS = frozenset(scriptTemplateValues("", "", 0))
+
+
+class _UnsupportedKeysKept(dict):
+    """
+    Format mapping which keeps unsupported keys in a template as they are.
+    """
+
+    def __missing__(self, key):
+        return f"{{{key}}}"
+
+
+def findUnsupportedTemplateKeys(script_template):
+    """
+    Find keys in a script template that will not be replaced.
+
+    Parameters
+    ----------
+
+    script_template : str
+       The script template string.
+
+    Returns
+    -------
+
+    keys : list
+       The unsupported keys, in order of first occurrence.
+
+    """
+    keys = []
+    for _, fn, _, _ in string.Formatter().parse(script_template):
+        if fn is not None and fn not in _SCRIPT_TEMPLATE_KEYS and fn not in keys:
+            keys.append(fn)
+    return keys
 
 
 def createArrayScriptFile(script_fp,
@@ -123,6 +483,9 @@ def createArrayScriptFile(script_fp,
        Path to the directory containing the CSV files.
        keys.
 
+    Unsupported keys in the template are left as they are, without warning.
+    findUnsupportedTemplateKeys lists them.
+
 
     Returns
     -------
@@ -132,24 +495,10 @@ def createArrayScriptFile(script_fp,
 
     """
 
-    modelname = os.path.basename(nlogofile).split('.')[0]
-
-    strformatter = string.Formatter()
-    formatmap = {
-        "experiment": experiment,
-        "numexps": numexps,
-        "model": nlogofile,
-        "modelname": modelname,
-        "csvfpath": csv_output_dir
-        }
-    # Use string formatter to go through the script template and
-    # look for unknown keys. Do not replace them, but print warning.
-    for _, fn, _, _ in strformatter.parse(script_template):
-        if fn is not None and fn not in formatmap.keys():
-            print(f"Warning: Unsupported key '{{{fn}}}' in script template. Ignoring.")
-            formatmap[fn] = f"{{{fn}}}"
+    formatmap = _UnsupportedKeysKept(scriptTemplateValues(
+        nlogofile, experiment, numexps, csv_output_dir))
 
-    script_fp.write(script_template.format(**formatmap))
+    script_fp.write(script_template.format_map(formatmap))
 
 
 def split_nlogo_experiment():
@@ -218,6 +567,12 @@ def split_nlogo_experiment():
                               this option preserves the paths given to the
                               program as they are and it is up to the user to
                               make sure these will work.""")
+    aparser.add_argument("-j", "--jobs", type=int,
+                         help="""Number of worker processes used to write the
+                              XML files. Defaults to the number of CPUs
+                              available to the program. Experiments with few
+                              runs, or a value of 1, are written without
+                              worker processes.""")
     aparser.add_argument("-v", "--version", action="version",
                          version=f"{__name__} {__version__}")
     aparser.add_argument("-d", "--debug", action="store_true", default=False,
@@ -225,21 +580,36 @@ def split_nlogo_experiment():
 
     args = aparser.parse_args()
 
+    if args.jobs is None or args.jobs < 1:
+        args.jobs = usableCPUCount()
+
     if args.debug:
         print(f"DEBUG: args = {args}")
 
-    experiments_xml = ""
+    experiments_xml = b""
     try:
-        with open(args.nlogo_file) as nlogof:
+        with open(args.nlogo_file, 'rb') as nlogof:
             # An .nlogo file contain a lot of non-xml data
             # this is a hack to ignore those lines and
             # read the experiments data into an xml string
-            # that can be parsed.
-            nlogo_text = nlogof.read()
-            alist = nlogo_text.split("<experiments>")
-            for elem in alist[1:]:
-                blist = elem.split("</experiments>")
-                experiments_xml += f"<experiments>{blist[0]}</experiments>\n"
+            # that can be parsed. Regular files are memory mapped so that
+            # only the experiments blocks are copied.
+            nlogo_map = None
+            if stat.S_ISREG(os.fstat(nlogof.fileno()).st_mode):
+                try:
+                    nlogo_map = mmap.mmap(nlogof.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+                except (ValueError, OSError):
+                    # Empty files cannot be mapped, nor can files on some
+                    # file systems. Read those instead.
+                    pass
+
+            if nlogo_map is not None:
+                with nlogo_map:
+                    experiments_xml = extractExperimentsXML(nlogo_map)
+            else:
+                # Pipes and other non-regular files.
+                experiments_xml = extractExperimentsXML(nlogof.read())
     except IOError as ioe:
         print(ioe.strerror + f" '{ioe.filename}'", file=sys.stderr)
         sys.exit(ioe.errno)
@@ -248,23 +618,29 @@ def split_nlogo_experiment():
     # We create absolute paths for some files and paths in case given relative.
 
     if args.no_path_translation is False:
-        args.output_dir = os.path.abspath(args.output_dir)
+        # Same as os.path.abspath, but only looks up the working directory
+        # once.
+        cwd = os.getcwd()
+
+        def absolutePath(path):
+            return os.path.normpath(os.path.join(cwd, path))
+
+        args.output_dir = absolutePath(args.output_dir)
+        if args.script_output_dir is not None:
+            args.script_output_dir = absolutePath(args.script_output_dir)
+        if args.csv_output_dir is not None:
+            args.csv_output_dir = absolutePath(args.csv_output_dir)
+
+        # This is the absolute path name of the nlogo model file.
+        nlogo_file_abs = absolutePath(args.nlogo_file)
+    else:
+        nlogo_file_abs = args.nlogo_file
 
     if args.script_output_dir is None:
         args.script_output_dir = args.output_dir
-    elif args.no_path_translation is False:
-        args.script_output_dir = os.path.abspath(args.script_output_dir)
 
     if args.csv_output_dir is None:
         args.csv_output_dir = args.output_dir
-    elif args.no_path_translation is False:
-        args.csv_output_dir = os.path.abspath(args.csv_output_dir)
-
-    # This is the absolute path name of the nlogo model file.
-    if args.no_path_translation is False:
-        nlogo_file_abs = os.path.abspath(args.nlogo_file)
-    else:
-        nlogo_file_abs = args.nlogo_file
 
     # Check if scripts should be generated and read the template file.
     if args.script_template_file is not None:
@@ -278,23 +654,25 @@ def split_nlogo_experiment():
 
             sys.stdout.write(f"tst {args.repetitions_per_run}: ")
 
+        # Unknown keys in the template are not replaced, but print warning.
+        for fn in findUnsupportedTemplateKeys(script_template_string):
+            print(f"Warning: Unsupported key '{{{fn}}}' in script template. Ignoring.")
+
     #
     # Start processing.
     #
-    original_dom = minidom.parseString(experiments_xml)
-
-    # Need a document to create nodes.
-    # Create a new experiments document to use as container.
-    experimentDoc = minidom.getDOMImplementation().createDocument(None, "experiments", None)
+    # There may be several experiments blocks, wrap them in a synthetic root
+    # element so that they can be parsed as a single document.
+    original_root = etree.fromstring(b"<root>" + experiments_xml + b"</root>")
 
     # Remember which experiments were processed.
     processed_experiments = {}
 
-    for orig_experiment in original_dom.getElementsByTagName("experiment"):
-        orig_exp_name = orig_experiment.getAttribute("name")
+    for orig_experiment in original_root.iter("experiment"):
+        orig_exp_name = orig_experiment.get("name")
         if args.all_experiments or (orig_exp_name in args.experiment):
 
-            experiment = orig_experiment.cloneNode(deep=True)
+            experiment = copy.deepcopy(orig_experiment)
 
             if args.debug:
                 print(f"DEBUG: orig_exp_name = {orig_exp_name}")
@@ -306,7 +684,7 @@ def split_nlogo_experiment():
 
             # Number of repetitions in the experiment.
             # Read original value first. Default is to have all internal.
-            reps_in_experiment = int(experiment.getAttribute("repetitions"))
+            reps_in_experiment = int(experiment.get("repetitions"))
 
             # Repeats of the created experiment.
             reps_of_experiment = 1
@@ -314,7 +692,7 @@ def split_nlogo_experiment():
             # Check if we should split experiments.
             # An unset switch or value <= 0 means no splitting.
             if args.repetitions_per_run > 0:
-                original_reps = int(experiment.getAttribute("repetitions"))
+                original_reps = int(experiment.get("repetitions"))
 
                 if args.debug:
                     print(f"DEBUG: args.repetitions_per_run = {args.repetitions_per_run}")
@@ -338,110 +716,135 @@ def split_nlogo_experiment():
                               file=sys.stderr)
 
             # Handle enumeratedValueSets
-            for evs in experiment.getElementsByTagName("enumeratedValueSet"):
-                values = evs.getElementsByTagName("value")
+            for evs in experiment.findall("enumeratedValueSet"):
+                values = evs.findall("value")
 
                 # If an enumeratedValueSet has more than a single value, it
                 # should be included in the value expansion tuples.
                 if len(values) > 1:
                     # A tuple is the name of the variable and
-                    # A list of all the values.
-                    value_tuples.append((evs.getAttribute("variable"),
-                                         [val.getAttribute("value") for val in values]))
+                    # A tuple of all the values.
+                    value_tuples.append((evs.get("variable"),
+                                         tuple(val.get("value") for val in values)))
                     num_individual_runs *= len(value_tuples[-1][1])
 
                     # Remove the node.
-                    experiment.removeChild(evs)
+                    experiment.remove(evs)
 
             # Handle steppedValueSet. These are integers (Java BigDecimal),
             # and inclusive of last value.
-            for svs in experiment.getElementsByTagName("steppedValueSet"):
-                first = int(svs.getAttribute("first"))
-                last = int(svs.getAttribute("last"))
-                step = int(svs.getAttribute("step"))
-
-                # Add values to the tuple list.
-                value_tuples.append((svs.getAttribute("variable"),
-                                     [x for x in range(first, last+1, step)]))
+            for svs in experiment.findall("steppedValueSet"):
+                first = int(svs.get("first"))
+                last = int(svs.get("last"))
+                step = int(svs.get("step"))
+
+                # Add values to the tuple list. The range is kept as is rather
+                # than expanded into a list.
+                value_tuples.append((svs.get("variable"),
+                                     range(first, last+1, step)))
                 num_individual_runs *= len(value_tuples[-1][1])
 
                 # Remove node.
-                experiment.removeChild(svs)
+                experiment.remove(svs)
+
+            # The rest of the experiment is the same for all individual runs.
+            # Serialize it once, leaving out the closing tag so that the value
+            # sets of each run can be added at the end.
+            experiment.set("repetitions", str(reps_in_experiment))
+            if experiment.text is None:
+                experiment.text = ""
+            experiment_xml = etree.tostring(experiment,
+                                            encoding="us-ascii",
+                                            xml_declaration=False,
+                                            with_tail=False)
+            experiment_body = experiment_xml[:-len(_EXP_END_TAG)]
 
             # Now create the different individual runs.
-            enum = 1
-
-            # Keep track of the parameter values in a run table.
-            run_table = []
-            ENR_STR = "Experiment number"
             if num_individual_runs > 1:
-                vsgen = expandValueSets(value_tuples)
+                # Every combination of the variable values, each given as a
+                # list of (variable_name, value) tuples.
+                names = [t[0] for t in value_tuples]
+                vsgen = (list(zip(names, combo))
+                         for combo in itertools.product(*(t[1] for t in value_tuples)))
             else:
                 # If there were no experiments to expand create a dummy-
                 # expansion just to make sure the single experiment is still
                 # created.
+                names = []
                 vsgen = [[]]
 
-            for exp in vsgen:
-                for exp_clone in range(reps_of_experiment):
-                    # Add header in case we are on the first row.
-                    if enum == 1:
-                        run_table.append([ENR_STR])
-                    run_table.append([enum])
-
-                    experiment_instance = experiment.cloneNode(deep=True)
-                    experiment_instance.setAttribute("repetitions", str(reps_in_experiment))
-                    for evs_name, evs_value in exp:
-                        evs = experimentDoc.createElement("enumeratedValueSet")
-                        evs.setAttribute("variable", evs_name)
-                        vnode = experimentDoc.createElement("value")
-                        vnode.setAttribute("value", str(evs_value))
-                        evs.appendChild(vnode)
-                        experiment_instance.appendChild(evs)
-
-                        # Add header in case we are on first pass.
-                        if enum == 1:
-                            run_table[0].append(evs_name)
-
-                        # Always add the current value.
-                        run_table[-1].append(evs_value)
-
-                    # Replace some special characters (including space) with
-                    # chars that may cause problems in a file name.
-                    # This is NOT fail safe right now. Assuming some form of
-                    # useful experiment naming practice.
-                    experiment_name = experiment_instance.getAttribute("name").replace(' ', '_').replace('/', '-').replace('\\', '-')
-                    xml_filename = os.path.join(args.output_dir,
-                                                args.output_prefix + experiment_name
-                                                + '_'
-                                                + str(enum).zfill(len(str(num_individual_runs)))
-                                                + '.xml')
-                    try:
-                        with open(xml_filename, 'w') as xmlfile:
-                            saveExperimentToXMLFile(experiment_instance, xmlfile)
-                    except IOError as ioe:
-                        print(ioe.strerror + f" '{ioe.filename}'",
-                              file=sys.stderr)
-                        sys.exit(ioe.errno)
-
-                    enum += 1
-
-                processed_experiments[orig_exp_name] = (enum - 1)
+            # Replace some special characters (including space) with
+            # chars that may cause problems in a file name.
+            # This is NOT fail safe right now. Assuming some form of
+            # useful experiment naming practice.
+            experiment_name = experiment.get("name").translate(_NAME_XLATE)
+
+            # Each individual run is independent of the others, so they may
+            # be written by a pool of worker processes.
+            num_runs = num_individual_runs * reps_of_experiment
+            tasks = expandExperimentRuns(vsgen,
+                                         reps_of_experiment,
+                                         experiment_body,
+                                         args.output_dir,
+                                         args.output_prefix + experiment_name,
+                                         num_individual_runs)
+
+            # Keep track of the parameter values in a run table. Rows are
+            # written as the runs are saved rather than kept in memory. The
+            # table is written under a temporary name and only moved into
+            # place once all runs are saved, so a failure does not leave a
+            # partial table behind.
+            ENR_STR = "Experiment number"
+            run_table_part_name = None
+            try:
+                with contextlib.ExitStack() as stack:
+                    run_table_file = None
+                    if args.create_run_table:
+                        run_table_file_name = os.path.join(args.output_dir,
+                                                           args.output_prefix
+                                                           + experiment_name
+                                                           + "_run_table.csv")
+                        run_table_part_name = run_table_file_name + ".part"
+                        run_table_file = stack.enter_context(
+                            open(run_table_part_name, 'wb',
+                                 buffering=_BUFFER_SIZE))
+                        run_table_file.write(formatRunTableRow([ENR_STR] + names))
+
+                    if args.jobs == 1 or num_runs < _PARALLEL_MIN_RUNS:
+                        # Too few runs, or CPUs, to be worth starting worker
+                        # processes for.
+                        results = map(emitExperimentRun, tasks)
+                    else:
+                        executor = stack.enter_context(
+                            ProcessPoolExecutor(max_workers=args.jobs))
+                        chunks = iter(
+                            lambda: list(itertools.islice(tasks, _PARALLEL_CHUNKSIZE)),
+                            [])
+                        results = itertools.chain.from_iterable(mapInWindow(
+                            executor, emitExperimentRuns, chunks,
+                            _PARALLEL_QUEUED_CHUNKS * args.jobs))
+
+                    for _, run_row in results:
+                        if run_table_file is not None:
+                            run_table_file.write(formatRunTableRow(run_row))
+
+                if run_table_part_name is not None:
+                    os.replace(run_table_part_name, run_table_file_name)
+            except IOError as ioe:
+                # Refer to the run table by its final name, not the temporary
+                # one.
+                filename = ioe.filename
+                if run_table_part_name is not None and filename == run_table_part_name:
+                    filename = run_table_file_name
+                print(ioe.strerror + f" '{filename}'", file=sys.stderr)
+                sys.exit(ioe.errno)
+            finally:
+                # Only left if something failed.
+                if run_table_part_name is not None:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(run_table_part_name)
 
-            # Check if the run table should be saved.
-            if args.create_run_table:
-                run_table_file_name = os.path.join(args.output_dir,
-                                                   args.output_prefix
-                                                   + experiment_name
-                                                   + "_run_table.csv")
-                try:
-                    with open(run_table_file_name, 'w') as run_table_file:
-                        rt_csv_writer = csv.writer(run_table_file)
-                        for row in run_table:
-                            rt_csv_writer.writerow(row)
-                except IOError as ioe:
-                    print(ioe.strerror + f" '{ioe.filename}'", file=sys.stderr)
-                    sys.exit(ioe.errno)
+            processed_experiments[orig_exp_name] = num_runs
 
     # Should a script file be created?
     # Want one array job script per experiment, to cover all
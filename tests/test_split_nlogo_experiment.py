@@ -0,0 +1,75 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+NLOGO_TEMPLATE = """\
+to setup
+end
+@#$#@#$#@
+<experiments>
+  <experiment name="single" repetitions="1" runMetricsEveryStep="true">
+    <setup>setup</setup>
+    {value_sets}
+  </experiment>
+</experiments>
+@#$#@#$#@
+"""
+
+
+def splitExperiment(value_sets, output_dir):
+    """
+    Split an experiment with the given value sets and return the contents of
+    its run table.
+    """
+    nlogo_file = os.path.join(output_dir, "model.nlogo")
+    with open(nlogo_file, "w") as nlogof:
+        nlogof.write(NLOGO_TEMPLATE.format(value_sets=value_sets))
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    subprocess.run([sys.executable, "-m", "split_nlogo_experiment",
+                    "--nlogo_file", nlogo_file, "--all_experiments",
+                    "--output_dir", output_dir, "--create_run_table"],
+                   check=True, env=env, stdout=subprocess.DEVNULL)
+    with open(os.path.join(output_dir, "single_run_table.csv")) as rtf:
+        return rtf.read().splitlines()
+
+
+class RunTableTest(unittest.TestCase):
+
+    def testExpandedValueSets(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            run_table = splitExperiment(
+                """<enumeratedValueSet variable="alpha">
+                     <value value="1"/>
+                     <value value="2"/>
+                   </enumeratedValueSet>
+                   <steppedValueSet variable="gamma" first="0" step="5" last="5"/>""",
+                output_dir)
+        self.assertEqual(run_table, ["Experiment number,alpha,gamma",
+                                     "1,1,0",
+                                     "2,1,5",
+                                     "3,2,0",
+                                     "4,2,5"])
+
+    def testSingleRunSteppedValueSet(self):
+        # A stepped value set giving a single value does not expand the
+        # experiment, so the run table has no variable columns.
+        with tempfile.TemporaryDirectory() as output_dir:
+            run_table = splitExperiment(
+                """<steppedValueSet variable="gamma" first="3" step="1" last="3"/>""",
+                output_dir)
+        self.assertEqual(run_table, ["Experiment number", "1"])
+
+    def testEmptySteppedValueSet(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            run_table = splitExperiment(
+                """<steppedValueSet variable="gamma" first="3" step="1" last="2"/>""",
+                output_dir)
+        self.assertEqual(run_table, ["Experiment number", "1"])
+
+
+if __name__ == "__main__":
+    unittest.main()